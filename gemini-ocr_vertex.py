@@ -1,10 +1,31 @@
 import os
 import re
 import json
+import mmap
+import time
+import hashlib
+import tempfile
+import random
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import gspread
 from google.oauth2 import service_account
+from google.api_core import exceptions as google_exceptions
+from google.cloud import storage
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part
+from vertexai.batch_prediction import BatchPredictionJob
+from vertexai.generative_models import GenerationConfig, GenerativeModel, Part
+
+try:
+    import fitz  # PyMuPDF (선택 사항: 텍스트 레이어가 있는 PDF는 비전 처리를 생략)
+except ImportError:
+    fitz = None
+
+try:
+    import json_repair  # 선택 사항: 형식이 깨진 JSON 응답 복구
+except ImportError:
+    json_repair = None
 
 # --- ⚙️ 1. 사용자 설정 ---
 GCP_PROJECT_ID = "pdf-ocr-project-464708"
@@ -12,6 +33,28 @@ GCP_LOCATION = "us-central1"
 SERVICE_ACCOUNT_FILE = 'pdf-ocr.json'
 SPREADSHEET_NAME = 'pdf-ocr'
 PDF_FOLDER_PATH = './pdfs/'
+MAX_WORKERS = 8  # 동시에 처리할 Gemini 요청 수
+PDF_HANDLING = "vision"  # "vision": 항상 PDF 전송 (표 구조 유지, 권장), "auto": 텍스트 레이어가 충분하면 텍스트로 전송, "text": 항상 텍스트로 전송
+MIN_TEXT_CHARS_PER_PAGE = 200  # "auto" 모드에서 텍스트 레이어로 인정할 페이지당 최소 글자 수
+MIN_TEXT_PAGE_RATIO = 0.8      # "auto" 모드에서 텍스트가 있어야 하는 페이지 비율
+USE_CACHE = True                 # 같은 PDF + 프롬프트 + 모델 조합의 추출 결과를 디스크에 캐시
+CACHE_DIR = './.gemini_cache/'
+SHEET_STATE_FILE = './.sheet_state.json'  # 헤더 확인 결과 저장 (시트를 비웠다면 이 파일을 삭제)
+PROCESSED_STATE_FILE = './.processed.txt'  # 스프레드시트별로 기록을 마친 PDF 목록과 sha256 (전체를 다시 처리하려면 이 파일을 삭제)
+SKIP_PROCESSED = True  # 이전 실행에서 기록을 마친 PDF는 건너뜀
+MODEL_NAME = "gemini-2.5-flash"          # 기본 모델 (빠르고 저렴)
+FALLBACK_MODEL_NAME = "gemini-2.5-pro"   # 기본 모델 응답이 검증에 실패하거나 핵심 필드가 비어 있으면 다시 추출할 모델
+# 모든 안내문의 모든 행에 있어야 하는 필드. 기본 모델 결과에서 비어 있으면 대체 모델로 다시 추출
+# (사업자 등록번호·상호 등은 '사업소득지급명세서 등 결정자료' 행처럼 원래 비어 있는 경우가 많으므로 판단에 사용하지 않음)
+UPGRADE_CORE_FIELDS = ("성명",)
+GCS_BUCKET = ""          # 일괄 예측용 GCS 경로 (예: "gs://my-bucket/pdf-ocr"). 비워두면 일괄 예측을 사용하지 않음 (PDF_HANDLING="vision"에서만 사용)
+BATCH_THRESHOLD = 20     # PDF가 이 개수를 넘으면 Vertex AI 일괄 예측(Batch Prediction) 사용
+BATCH_POLL_SECONDS = 30  # 일괄 예측 작업 상태 확인 간격(초)
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/cloud-platform"
+]
 
 # --- 🤖 2. 추출 필드 및 프롬프트 ---
 # EXTRACTION_FIELDS를 프롬프트와 일치하도록 간소화합니다.
@@ -24,10 +67,8 @@ EXTRACTION_FIELDS = [
     "업종 코드", "사업 형태", "기장 의무", "경비율",
     "수입금액", "일반", "자가", "일반(기본)", "자가(초과)"
 ]
-json_example = "[\n" + "  {\n" + ",\n".join([f'    "{field}": "값"' for field in EXTRACTION_FIELDS]) + "\n  }\n]"
-
-
-GEMINI_PROMPT = f"""
+# 출력 형식과 필드 목록은 RESPONSE_SCHEMA로 전달하므로 프롬프트에는 작업 지침만 포함합니다.
+GEMINI_PROMPT = """
 ## 역할
 당신은 주어진 문서 전체를 종합적으로 분석하여, 여러 다른 위치와 형식의 표나 텍스트에서 데이터를 정확히 추출하고 구조화된 JSON으로 변환하는 OCR 전문가입니다.
 
@@ -43,6 +84,7 @@ GEMINI_PROMPT = f"""
 '사업장별 수입금액'과 관련된 표를 찾습니다. 이 표는 여러 행(여러 사업 소득)을 포함할 수 있습니다. 각 행에서 다음 필드들을 추출합니다.
 - "사업자 등록번호", "상호", "수입종류 구분코드", "업종 코드", "수입금액", "경비율" 등
 - "경비을" 또는 "경비율"은 "경비율" 필드에 포함됩니다.
+- "수입종류 구분코드" 열의 값은 "수입금액 구분코드" 필드에 넣습니다.
 - **[매우 중요]** 하나의 셀 안에 텍스트가 여러 줄로 나뉘어 있을 때, 이 텍스트 덩어리 전체는 **하나의 값**입니다. 예를 들어, 이미지의 '사업소득지급명세\n서 등 결정자료'라는 텍스트는 **전체가 '수입종류 구분코드' 열에 속하는 하나의 값**입니다. 옆 칸인 '상호'가 비어있다고 해서 텍스트의 일부를 '상호'의 값으로 절대 할당해서는 안됩니다.
 
 ### 3단계: JSON 객체 생성 및 병합
@@ -54,69 +96,660 @@ GEMINI_PROMPT = f"""
 3단계에서 생성된 모든 JSON 객체들을 하나의 JSON 리스트(배열)로 묶어 최종 결과를 만듭니다.
 
 ## 최종 지시
-위의 단계별 지침을 엄격하게 따라서, 문서 전체의 정보를 종합하여 JSON 리스트(배열) 형태로 출력해주세요. 다른 설명은 절대 추가하지 마세요.
-
-### 추출할 항목
-{', '.join(EXTRACTION_FIELDS)}
-
-### 출력 형식
-결과는 반드시 아래와 같은 **JSON 리스트(배열)** 형식으로만 응답해야 합니다.
-{json_example}
+위의 단계별 지침을 엄격하게 따라서, 문서 전체의 정보를 종합하여 지정된 스키마의 JSON 리스트(배열) 형태로 출력해주세요. 값을 찾을 수 없는 항목은 "N/A"로 채우고, 다른 설명은 절대 추가하지 마세요.
 """
 
+# --- 📐 응답 스키마 (JSON 모드) ---
+RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {field: {"type": "STRING"} for field in EXTRACTION_FIELDS},
+        "required": EXTRACTION_FIELDS,
+    },
+}
+GENERATION_CONFIG = GenerationConfig(response_mime_type="application/json", response_schema=RESPONSE_SCHEMA)
+
 # --- 💰 숫자 정제 대상 필드 ---
 currency_fields = [
     "중간예납세액", "원천징수세액", "국민연금보험료", "개인연금저축",
     "소기업소상공인공제부금 (노란우산공제)", "퇴직연금세액공제", "연금계좌세액공제", "수입금액"
 ]
 
+# 행 생성 시 반복 조회되는 필드 목록과 집합은 한 번만 생성
+_FIELDS = tuple(EXTRACTION_FIELDS)
+_CURRENCY_SET = frozenset(currency_fields)
+_TRANS_NL = str.maketrans({"\n": " "})
+
 # --- 🔧 유틸리티 함수 ---
+# 자주 호출되는 정규식과 테이블은 모듈 로드 시 한 번만 생성
+_EMPTY_VALUES = frozenset(["", "없음", "N/A"])
+_NON_DIGIT_RE = re.compile(r"[^\d]")
+_ASCII_NON_DIGITS = "".join(chr(c) for c in range(128) if not chr(c).isdigit())
+_DIGITS_ONLY_TABLE = str.maketrans("", "", _ASCII_NON_DIGITS)
+
 def clean_currency(value: str) -> str:
     if not isinstance(value, str): return "0"
-    if value.strip() in ["", "없음", "N/A"]: return "0"
-    cleaned = re.sub(r"[^\d]", "", value)
+    if value.strip() in _EMPTY_VALUES: return "0"
+    # ASCII 문자열은 정규식 대신 str.translate로 숫자만 남김 (한글 등 비ASCII는 정규식 사용)
+    cleaned = value.translate(_DIGITS_ONLY_TABLE) if value.isascii() else _NON_DIGIT_RE.sub("", value)
     return cleaned if cleaned else "0"
 
-def extract_data_with_gemini(project_id, location, file_path, prompt, credentials):
-    print(f"\n📄 '{os.path.basename(file_path)}' 파일 처리 시작...")
-    vertexai.init(project=project_id, location=location, credentials=credentials)
-    model = GenerativeModel("gemini-2.5-pro")
-    
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"오류: PDF 파일을 찾을 수 없습니다. 경로: {file_path}")
+# --- 🔁 재시도(지수 백오프) 설정 ---
+MAX_API_RETRIES = 6          # 최초 호출 포함 최대 시도 횟수
+BACKOFF_MAX_SECONDS = 60     # 재시도 간 최대 대기 시간(초)
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.ResourceExhausted,   # 429 (할당량 초과)
+    google_exceptions.ServiceUnavailable,  # 503
+    google_exceptions.DeadlineExceeded,    # 504
+    google_exceptions.InternalServerError, # 500
+)
+RETRYABLE_HTTP_STATUS = {429, 500, 503}
 
-    with open(file_path, "rb") as f:
-        pdf_content = f.read()
-
-    pdf_part = Part.from_data(data=pdf_content, mime_type="application/pdf")
-    print("🧠 Gemini에게 데이터 추출을 요청합니다...")
-    response = model.generate_content([pdf_part, prompt])
-
-    # 👇 [수정됨] JSON 리스트를 찾도록 정규식 변경
-    match = re.search(r"\[.*\]", response.text, re.DOTALL)
-    if not match:
-        # Markdown 코드 블록(```json ... ```)도 찾아보도록 로직 추가
-        match_md = re.search(r"```json\s*(\[.*\])\s*```", response.text, re.DOTALL)
-        if not match_md:
-            raise ValueError(f"Gemini 응답에서 유효한 JSON 리스트를 찾지 못했습니다. 응답: {response.text}")
-        response_text = match_md.group(1)
+def is_retryable_error(e: Exception) -> bool:
+    """
+    재시도하면 해결될 수 있는 일시적인 오류(429, 5xx)인지 확인합니다.
+    """
+    if isinstance(e, RETRYABLE_EXCEPTIONS):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        return getattr(e.response, "status_code", None) in RETRYABLE_HTTP_STATUS
+    return False
+
+def get_server_retry_delay(e: Exception):
+    """
+    서버가 지정한 재시도 대기 시간(초)을 반환합니다. 없으면 None을 반환합니다.
+    """
+    # Gemini/Vertex: RetryInfo.retry_delay
+    for detail in getattr(e, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(e))
+    if match:
+        return float(match.group(1))
+    # Sheets API: Retry-After 헤더
+    response = getattr(e, "response", None)
+    retry_after = getattr(response, "headers", {}).get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return None
+
+def call_with_backoff(func, *args, **kwargs):
+    """
+    일시적인 API 오류 발생 시 지수 백오프(2^n + 지터)로 재시도하며 함수를 호출합니다.
+    """
+    for attempt in range(MAX_API_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == MAX_API_RETRIES - 1 or not is_retryable_error(e):
+                raise
+            delay = get_server_retry_delay(e)
+            if delay is None:
+                delay = min(BACKOFF_MAX_SECONDS, 2 ** attempt + random.uniform(0, 1))
+            print(f"⏳ 일시적인 API 오류({type(e).__name__}). {delay:.1f}초 후 재시도합니다... ({attempt + 1}/{MAX_API_RETRIES - 1})")
+            time.sleep(delay)
+
+def flush_rows(worksheet, rows):
+    """
+    모아둔 행들을 한 번의 API 호출로 시트에 추가합니다.
+    """
+    if not rows:
+        return
+    print(f"\n📤 {len(rows)}개의 행을 스프레드시트에 한 번에 기록합니다...")
+    # RAW: 서버 측 수식 해석을 건너뜀
+    call_with_backoff(worksheet.append_rows, rows, value_input_option='RAW', insert_data_option='INSERT_ROWS')
+
+def build_data_row(file_name_to_log, extracted_data):
+    """
+    추출된 JSON 객체 하나를 시트에 기록할 행으로 변환합니다.
+    """
+    data_row = [file_name_to_log]
+    data_row.extend(
+        clean_currency(str(value)) if field in _CURRENCY_SET
+        else value.translate(_TRANS_NL) if isinstance(value, str)
+        else value
+        for field, value in ((field, extracted_data.get(field, 'N/A')) for field in _FIELDS)
+    )
+    return data_row
+
+def load_sheet_state() -> dict:
+    """
+    스프레드시트 상태 파일(.sheet_state.json)을 읽습니다.
+    """
+    try:
+        with open(SHEET_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_sheet_state(state: dict):
+    with open(SHEET_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+
+def ensure_headers(spreadsheet, worksheet, headers):
+    """
+    시트 1행에 헤더가 없으면 추가합니다. 이전 실행에서 같은 헤더를 확인했다면 API 호출을 생략합니다.
+    """
+    headers_hash = hashlib.md5("\t".join(headers).encode("utf-8")).hexdigest()
+    sheet_state = load_sheet_state()
+    if sheet_state.get(spreadsheet.id, {}).get("headers_hash") == headers_hash:
+        print("📝 헤더가 이미 존재합니다. (저장된 상태 사용)")
+        return
+
+    first_row = worksheet.row_values(1)
+    if not first_row:
+        print("📝 1행이 비어있어 헤더를 추가합니다...")
+        call_with_backoff(worksheet.append_row, headers)
     else:
-        response_text = match.group(0)
+        print("📝 헤더가 이미 존재합니다.")
+
+    sheet_state[spreadsheet.id] = {"headers_written": True, "headers_hash": headers_hash}
+    save_sheet_state(sheet_state)
+
+def list_pdf_files(folder_path: str):
+    """
+    폴더의 PDF 파일을 (이름, 크기, 수정 시각) 목록으로 반환합니다. 작은 파일부터 처리하도록 크기순으로 정렬합니다.
+    """
+    pdf_entries = []
+    with os.scandir(folder_path) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith('.pdf'):
+                stat = entry.stat()  # scandir가 이미 조회한 정보를 재사용
+                pdf_entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    pdf_entries.sort(key=lambda pdf_entry: pdf_entry[1])
+    return pdf_entries
+
+def _stat_key(pdf_entry) -> str:
+    return "\t".join(str(value) for value in pdf_entry)
+
+def file_sha256(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+def load_processed_files(spreadsheet_id: str):
+    """
+    이전 실행에서 이 스프레드시트에 기록을 마친 PDF 목록을 읽습니다. (.sheet_state.json처럼 spreadsheet.id 기준)
+    (이름, 크기, 수정 시각) 키 집합과 파일 이름별 sha256 집합을 반환합니다.
+    """
+    stat_keys, hashes_by_name = set(), {}
+    try:
+        with open(PROCESSED_STATE_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 5 or parts[0] != spreadsheet_id:
+                    continue
+                stat_keys.add("\t".join(parts[1:4]))
+                hashes_by_name.setdefault(parts[1], set()).add(parts[4])
+    except FileNotFoundError:
+        pass
+    return stat_keys, hashes_by_name
+
+def is_processed(pdf_entry, stat_keys, hashes_by_name) -> bool:
+    """
+    크기와 수정 시각이 같으면 바로 처리된 것으로 보고, 다르면 내용(sha256)을 비교합니다.
+    """
+    if _stat_key(pdf_entry) in stat_keys:
+        return True
+    known_hashes = hashes_by_name.get(pdf_entry[0])
+    if not known_hashes:
+        return False  # 한 번도 기록된 적 없는 파일은 해시를 계산하지 않음
+    return file_sha256(os.path.join(PDF_FOLDER_PATH, pdf_entry[0])) in known_hashes
+
+def mark_processed_files(spreadsheet_id: str, pdf_entries):
+    """
+    이 스프레드시트에 기록을 마친 PDF를 sha256과 함께 상태 파일에 추가합니다.
+    """
+    if not pdf_entries:
+        return
+    with open(PROCESSED_STATE_FILE, "a", encoding="utf-8") as f:
+        for pdf_entry in pdf_entries:
+            sha256 = file_sha256(os.path.join(PDF_FOLDER_PATH, pdf_entry[0]))
+            f.write(f"{spreadsheet_id}\t{_stat_key(pdf_entry)}\t{sha256}\n")
+
+def try_text_extract(file_path: str, check_coverage: bool = True):
+    """
+    PyMuPDF로 PDF의 텍스트 레이어를 추출합니다. 텍스트가 충분하지 않으면 None을 반환합니다.
+    """
+    if fitz is None:
+        return None
+    try:
+        with fitz.open(file_path) as doc:
+            # 표의 셀 구분이 유지되도록 블록(셀) 단위로 읽기 순서대로 추출하고, 블록 사이는 빈 줄로 구분
+            page_texts = [
+                "\n\n".join(block[4].strip() for block in page.get_text("blocks", sort=True) if block[6] == 0)
+                for page in doc
+            ]
+    except Exception as e:
+        print(f"⚠️ '{os.path.basename(file_path)}' PDF 텍스트 추출 실패: {e}")
+        return None
+
+    text = "\n".join(page_texts).strip()
+    if not text:
+        return None
+    if check_coverage:
+        # 스캔본처럼 텍스트 레이어가 부실한 PDF는 비전 처리로 보냄
+        pages_with_text = sum(1 for page_text in page_texts if page_text.strip())
+        if pages_with_text / len(page_texts) < MIN_TEXT_PAGE_RATIO:
+            return None
+        if len(text) / len(page_texts) < MIN_TEXT_CHARS_PER_PAGE:
+            return None
+    return text
+
+def get_document_text(file_path: str):
+    """
+    PDF_HANDLING 설정에 따라 PDF 대신 전송할 텍스트를 반환합니다. 비전 처리가 필요하면 None을 반환합니다.
+    """
+    if PDF_HANDLING == "vision":
+        return None
+    text = try_text_extract(file_path, check_coverage=(PDF_HANDLING == "auto"))
+    if text is None and PDF_HANDLING == "text":
+        raise ValueError("PDF에서 텍스트를 추출하지 못했습니다. (PyMuPDF 설치 여부 또는 텍스트 레이어를 확인하세요)")
+    if text is not None:
+        print(f"📝 '{os.path.basename(file_path)}': PDF 텍스트 레이어를 사용합니다. (비전 처리 생략)")
+    return text
+
+def build_document_text_section(document_text: str) -> str:
+    return (
+        "## 문서 텍스트\n"
+        "아래는 PDF 이미지 대신 텍스트 레이어에서 추출한 내용입니다. 지침의 '이미지'와 '셀'은 이 텍스트를 가리킵니다.\n"
+        "표의 각 셀은 빈 줄로 구분된 블록이며, 한 블록 안에서 여러 줄로 나뉜 텍스트는 하나의 셀 값입니다.\n\n"
+        f"{document_text}"
+    )
+
+def build_text_prompt(prompt: str, document_text: str) -> str:
+    return f"{prompt}\n\n{build_document_text_section(document_text)}"
+
+def make_cache_key(pdf_bytes, prompt: str, model_name: str) -> str:
+    """
+    PDF 내용(bytes 또는 mmap), 프롬프트, 모델 이름으로 캐시 키(SHA-256)를 만듭니다.
+    """
+    hasher = hashlib.sha256(pdf_bytes)
+    hasher.update(prompt.encode("utf-8"))
+    hasher.update(model_name.encode("utf-8"))
+    return hasher.hexdigest()
+
+def load_cached_response(cache_key: str):
+    """
+    디스크 캐시에 저장된 추출 결과를 반환합니다. 없으면 None을 반환합니다.
+    """
+    if not USE_CACHE:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, f"{cache_key}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["response"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return None
+
+def save_cached_response(cache_key: str, response, model_name: str, prompt: str):
+    """
+    추출 결과를 디스크 캐시에 저장합니다. (임시 파일에 쓴 뒤 os.replace로 원자적으로 교체)
+    """
+    if not USE_CACHE:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entry = {
+        "response": response,
+        "model": model_name,
+        "prompt_hash": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(CACHE_DIR, f"{cache_key}.json"))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+@functools.lru_cache(maxsize=1)
+def get_credentials(service_account_file: str):
+    """
+    서비스 계정 인증 정보를 한 번만 읽어 재사용합니다.
+    """
+    return service_account.Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
+
+@functools.lru_cache(maxsize=None)
+def get_model(model_name: str):
+    """
+    모델 이름별 GenerativeModel 인스턴스를 한 번만 만들어 재사용합니다.
+    """
+    return GenerativeModel(model_name, generation_config=GENERATION_CONFIG)
+
+_CLOSING_BRACKETS = {"[": "]", "{": "}"}
+
+def _balanced_json_span(text: str):
+    """
+    첫 '[' 또는 '{'부터 괄호 짝이 맞는 구간을 한 번의 순회로 찾습니다. (문자열 안의 괄호와 이스케이프는 무시)
+    (구간, 잘림 여부)를 반환합니다. 응답이 중간에 잘렸다면 열린 문자열과 괄호를 닫은 구간과 True를 반환하며,
+    이 경우 마지막 행의 값이 빠져 있으므로 호출하는 쪽에서 실패로 처리해야 합니다.
+    """
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if not starts:
+        return None, False
+    start = min(starts)
+    stack = []
+    in_str = False
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c in _CLOSING_BRACKETS:
+            stack.append(_CLOSING_BRACKETS[c])
+        elif c == "]" or c == "}":
+            if stack.pop() != c:
+                return None, False  # 괄호 짝이 맞지 않음
+            if not stack:
+                return text[start:i + 1], False
+    # 잘린 응답: 열린 문자열과 괄호를 순서대로 닫음
+    return text[start:] + ('"' if in_str else "") + "".join(reversed(stack)), True
+
+def parse_json_response(text: str):
+    """
+    JSON 모드로 받은 Gemini 응답을 파싱합니다. 앞뒤에 다른 텍스트가 붙었으면 괄호 짝이 맞는 JSON 구간만 잘라내고,
+    형식이 깨진 경우 json_repair로 복구를 시도합니다. 응답이 중간에 잘렸으면 일부 행만 남으므로 ValueError를 발생시킵니다.
+    """
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        span, truncated = _balanced_json_span(text)
+        if truncated:
+            # 닫는 괄호를 보충하면 파싱은 되지만 마지막 행이 불완전하므로 실패로 처리 (대체 모델로 재추출)
+            raise ValueError("Gemini 응답이 중간에 잘렸습니다.") from e
+        if span is not None:
+            try:
+                return json.loads(span)
+            except json.JSONDecodeError:
+                pass
+        if json_repair is None:
+            raise ValueError(f"Gemini 응답이 올바른 JSON이 아닙니다: {e}") from e
+        print("🩹 JSON 형식이 올바르지 않아 json_repair로 복구를 시도합니다...")
+        return json_repair.loads(text)
+
+def is_valid_extraction(data) -> bool:
+    """
+    추출 결과가 스키마(JSON 객체의 리스트)를 만족하는지 확인합니다.
+    """
+    return isinstance(data, list) and all(isinstance(item, dict) for item in data)
+
+_EMPTY_RESULT_VALUES = ("", "N/A", None)
+_routing_lock = threading.Lock()
+_routing_stats = {"total": 0, "upgraded": 0}
+
+def needs_upgrade(extracted_data) -> bool:
+    """
+    추출 결과가 비었거나 핵심 필드가 빠져 있어 대체 모델(Pro)로 다시 추출해야 하는지 판단합니다.
+    """
+    if not extracted_data:
+        return True
+    return any(
+        item.get(field) in _EMPTY_RESULT_VALUES
+        for item in extracted_data
+        for field in UPGRADE_CORE_FIELDS
+    )
+
+def record_model_routing(upgraded: bool):
+    """
+    대체 모델로 다시 추출한 비율을 집계합니다. (UPGRADE_CORE_FIELDS 점검용)
+    """
+    with _routing_lock:
+        _routing_stats["total"] += 1
+        if upgraded:
+            _routing_stats["upgraded"] += 1
+
+def extract_data_with_gemini(file_path, prompt):
+    file_name = os.path.basename(file_path)
+    print(f"\n📄 '{file_name}' 파일 처리 시작...")
 
-    print("✅ 데이터 추출 완료.")
-    return json.loads(response_text)
+    # 👇 텍스트 레이어가 있는 PDF는 텍스트만 보내 비전 처리를 생략
+    document_text = get_document_text(file_path)
+    request_prompt = build_text_prompt(prompt, document_text) if document_text is not None else prompt
+    contents = None
+
+    # 👇 기본 모델(Flash)로 먼저 추출하고, 응답이 스키마 검증에 실패하거나 핵심 필드가 비어 있을 때만 대체 모델(Pro)로 재추출
+    model_names = [MODEL_NAME] if MODEL_NAME == FALLBACK_MODEL_NAME else [MODEL_NAME, FALLBACK_MODEL_NAME]
+    extracted_result = None
+    upgraded = False
+
+    # 👇 PDF는 mmap으로 열어 해시 계산 시 전체를 메모리에 복사하지 않음
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pdf_view:
+        for index, model_name in enumerate(model_names):
+            upgraded = index > 0
+
+            # 👇 같은 PDF + 프롬프트 + 모델 조합은 캐시된 결과를 재사용 (재추출 비용도 한 번만 발생)
+            cache_key = make_cache_key(pdf_view, request_prompt, model_name)
+            cached_data = load_cached_response(cache_key)
+            if cached_data is not None and is_valid_extraction(cached_data):
+                print(f"💾 '{file_name}': 캐시된 {model_name} 추출 결과를 사용합니다.")
+                extracted_result = cached_data
+                if not needs_upgrade(cached_data):
+                    break
+                continue
+
+            # 실제 요청이 필요할 때만 PDF 바이트를 복사해 요청 내용을 만듦
+            if contents is None:
+                if document_text is not None:
+                    contents = [request_prompt]
+                else:
+                    pdf_part = Part.from_data(data=pdf_view[:], mime_type="application/pdf")
+                    contents = [pdf_part, prompt]
+
+            model = get_model(model_name)
+            print(f"🧠 '{file_name}': Gemini({model_name})에게 데이터 추출을 요청합니다...")
+            try:
+                response = call_with_backoff(model.generate_content, contents)
+            except Exception as e:
+                # 대체 모델 호출이 실패해도 기본 모델의 유효한 결과가 있으면 그 결과를 사용
+                if extracted_result is None:
+                    raise
+                print(f"⚠️ '{file_name}': {model_name} 호출 실패. {model_names[0]} 결과를 사용합니다: {e}")
+                break
+
+            try:
+                extracted_data = parse_json_response(response.text)
+            except ValueError as e:
+                print(f"⚠️ '{file_name}': {model_name} 응답을 JSON으로 변환하지 못했습니다: {e}")
+                continue
+
+            if not is_valid_extraction(extracted_data):
+                print(f"⚠️ '{file_name}': {model_name} 응답이 스키마 검증에 실패했습니다.")
+                continue
+
+            save_cached_response(cache_key, extracted_data, model_name, request_prompt)
+            extracted_result = extracted_data
+            if not needs_upgrade(extracted_data):
+                break
+            print(f"🔼 '{file_name}': {model_name} 결과에 핵심 필드({', '.join(UPGRADE_CORE_FIELDS)})가 비어 있습니다.")
+
+    record_model_routing(upgraded)
+    if extracted_result is None:
+        raise ValueError(f"Gemini 응답에서 유효한 JSON 리스트를 찾지 못했습니다. 파일: {file_name}")
+    print(f"✅ '{file_name}': 데이터 추출 완료.")
+    return extracted_result
+
+def find_file_uri(request: dict):
+    """
+    일괄 예측 결과에 포함된 요청에서 PDF의 GCS URI를 찾습니다.
+    """
+    for content in request.get("contents", []):
+        for part in content.get("parts", []):
+            file_data = part.get("fileData") or part.get("file_data")
+            if file_data:
+                return file_data.get("fileUri") or file_data.get("file_uri")
+    return None
+
+def run_batch_prediction(pdf_files, prompt, credentials):
+    """
+    Vertex AI 일괄 예측으로 여러 PDF를 한 번에 처리합니다. {파일 이름: 추출 결과 또는 예외}를 반환합니다.
+    일괄 예측은 항상 PDF를 비전으로 처리하므로 PDF_HANDLING="vision"일 때만 사용합니다.
+    (캐시 키도 파일별 요청의 비전 처리와 같은 PDF + 프롬프트 + 모델 조합이라 결과를 서로 재사용)
+    """
+    bucket_name, _, prefix = GCS_BUCKET.removeprefix("gs://").partition("/")
+    run_prefix = "/".join(filter(None, [prefix.strip("/"), time.strftime("%Y%m%d-%H%M%S")]))
+    bucket = storage.Client(project=GCP_PROJECT_ID, credentials=credentials).bucket(bucket_name)
+
+    results = {}
+    cache_keys = {}
+    uri_to_file = {}
+    request_lines = []
+    job = None
+    # 업로드 도중 실패하거나 중단되어도 이미 올린 파일을 정리하도록 업로드부터 try 안에서 수행
+    try:
+        for pdf_file in pdf_files:
+            full_path = os.path.join(PDF_FOLDER_PATH, pdf_file)
+            with open(full_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as pdf_view:
+                cache_keys[pdf_file] = make_cache_key(pdf_view, prompt, MODEL_NAME)
+            cached_data = load_cached_response(cache_keys[pdf_file])
+            if cached_data is not None and is_valid_extraction(cached_data):
+                print(f"💾 '{pdf_file}': 캐시된 추출 결과를 사용합니다.")
+                results[pdf_file] = cached_data
+                continue
+
+            blob = bucket.blob(f"{run_prefix}/input/{pdf_file}")
+            call_with_backoff(blob.upload_from_filename, full_path, content_type="application/pdf")
+            file_uri = f"gs://{bucket_name}/{blob.name}"
+            uri_to_file[file_uri] = pdf_file
+            request_lines.append(json.dumps({
+                "request": {
+                    "contents": [{"role": "user", "parts": [
+                        {"fileData": {"fileUri": file_uri, "mimeType": "application/pdf"}},
+                        {"text": prompt},
+                    ]}],
+                    "generationConfig": {"responseMimeType": "application/json", "responseSchema": RESPONSE_SCHEMA},
+                }
+            }, ensure_ascii=False))
+
+        if not request_lines:
+            return results
+
+        manifest = bucket.blob(f"{run_prefix}/requests.jsonl")
+        call_with_backoff(manifest.upload_from_string, "\n".join(request_lines), content_type="application/jsonl")
+        print(f"☁️ {len(request_lines)}개의 PDF를 gs://{bucket_name}/{run_prefix} 에 업로드했습니다.")
+
+        job = BatchPredictionJob.submit(
+            source_model=MODEL_NAME,
+            input_dataset=f"gs://{bucket_name}/{manifest.name}",
+            output_uri_prefix=f"gs://{bucket_name}/{run_prefix}/output",
+        )
+        print(f"📦 일괄 예측 작업을 제출했습니다: {job.resource_name}")
+        while not job.has_ended:
+            time.sleep(BATCH_POLL_SECONDS)
+            job.refresh()
+            print(f"⏳ 일괄 예측 작업 상태: {job.state.name}")
+        if not job.has_succeeded:
+            raise RuntimeError(f"일괄 예측 작업 실패: {job.error}")
+
+        # 👇 결과 JSONL을 내려받아 파일별 추출 결과로 변환
+        output_prefix = job.output_location.removeprefix(f"gs://{bucket_name}/")
+        for blob in bucket.list_blobs(prefix=output_prefix):
+            if not blob.name.endswith(".jsonl"):
+                continue
+            for line in blob.download_as_text().splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                pdf_file = uri_to_file.get(find_file_uri(record.get("request", {})))
+                if pdf_file is None:
+                    continue
+                try:
+                    if record.get("status"):
+                        raise RuntimeError(record["status"])
+                    parts = record["response"]["candidates"][0]["content"]["parts"]
+                    extracted_data = parse_json_response("".join(part.get("text", "") for part in parts))
+                    if not is_valid_extraction(extracted_data):
+                        raise ValueError("Gemini 응답이 스키마 검증에 실패했습니다.")
+                    save_cached_response(cache_keys[pdf_file], extracted_data, MODEL_NAME, prompt)
+                    results[pdf_file] = extracted_data
+                except Exception as e:
+                    results[pdf_file] = e
+    finally:
+        # Ctrl-C 등으로 중단되었다면 제출한 작업을 취소 (끝나지 않은 작업이 계속 과금되지 않도록)
+        if job is not None and not job.has_ended:
+            try:
+                job.cancel()
+                print("🛑 일괄 예측 작업을 취소했습니다.")
+            except Exception as e:
+                print(f"⚠️ 일괄 예측 작업 취소 중 오류: {e}")
+        # 이번 실행에서 만든 GCS 파일(입력 PDF, 요청 목록, 결과)은 모두 삭제
+        for blob in bucket.list_blobs(prefix=f"{run_prefix}/"):
+            try:
+                blob.delete()
+            except Exception as e:
+                print(f"⚠️ GCS 파일 삭제 중 오류: {e}")
+
+    for pdf_file in uri_to_file.values():
+        results.setdefault(pdf_file, RuntimeError("일괄 예측 결과에서 이 파일을 찾지 못했습니다."))
+    return results
+
+def iter_extraction_results(pdf_files, credentials):
+    """
+    PDF별 추출 결과를 (파일 이름, 추출 결과 또는 예외) 형태로 완료되는 순서대로 반환합니다.
+    """
+    # 👇 PDF가 많으면 Vertex AI 일괄 예측으로 서버 측에서 한 번에 처리
+    # (일괄 예측은 비전 전용이므로, 텍스트 레이어를 쓰는 모드에서는 파일별 요청과 결과가 달라지지 않도록 사용하지 않음)
+    if GCS_BUCKET and PDF_HANDLING == "vision" and len(pdf_files) > BATCH_THRESHOLD:
+        print(f"\n📦 PDF가 {BATCH_THRESHOLD}개를 넘어 Vertex AI 일괄 예측을 사용합니다.")
+        try:
+            batch_results = run_batch_prediction(pdf_files, GEMINI_PROMPT, credentials)
+        except Exception as e:
+            print(f"⚠️ 일괄 예측 실패. 파일별 요청으로 처리합니다: {e}")
+        else:
+            # 👇 실패했거나 대체 모델(Pro)이 필요한 결과는 파일별 요청으로 다시 처리 (기본 모델 결과는 캐시되어 Pro 호출만 발생)
+            retry_files = []
+            for pdf_file, result in batch_results.items():
+                if isinstance(result, Exception) or needs_upgrade(result):
+                    retry_files.append(pdf_file)
+                else:
+                    record_model_routing(False)
+                    yield pdf_file, result
+            if not retry_files:
+                return
+            print(f"\n🔁 일괄 예측 결과 중 {len(retry_files)}개 파일을 파일별 요청으로 다시 처리합니다.")
+            pdf_files = retry_files
+
+    # 👇 Gemini 호출만 병렬로 실행하고, 스프레드시트 기록은 메인 스레드에서 처리 (gspread는 스레드 안전하지 않음)
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        futures = {
+            executor.submit(
+                extract_data_with_gemini, os.path.join(PDF_FOLDER_PATH, pdf_file), GEMINI_PROMPT
+            ): pdf_file
+            for pdf_file in pdf_files
+        }
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            yield futures[future], result
+    finally:
+        # Ctrl-C 등으로 중단되면 아직 시작하지 않은 PDF는 요청하지 않고, 진행 중인 요청도 기다리지 않고 바로 저장
+        # (정상 종료 시에는 모든 작업이 이미 끝난 상태)
+        executor.shutdown(wait=False, cancel_futures=True)
 
 # --- 🚀 Main ---
 def main():
     print("--- 🚀 PDF 일괄 처리 및 스프레드시트 입력을 시작합니다 ---")
 
     try:
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
-            "https://www.googleapis.com/auth/cloud-platform"
-        ]
-        creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
+        creds = get_credentials(SERVICE_ACCOUNT_FILE)
+        # Vertex AI 초기화는 실행당 한 번만 수행 (파일마다 인증/메타데이터 조회 반복 방지)
+        vertexai.init(project=GCP_PROJECT_ID, location=GCP_LOCATION, credentials=creds)
         client = gspread.authorize(creds)
         spreadsheet = client.open(SPREADSHEET_NAME)
         worksheet = spreadsheet.sheet1
@@ -126,60 +759,81 @@ def main():
         return
 
     try:
-        first_row = worksheet.row_values(1)
-        if not first_row:
-            print("📝 1행이 비어있어 헤더를 추가합니다...")
-            headers = ["파일이름"] + EXTRACTION_FIELDS
-            worksheet.append_row(headers)
-        else:
-            print("📝 헤더가 이미 존재합니다.")
+        ensure_headers(spreadsheet, worksheet, ["파일이름"] + EXTRACTION_FIELDS)
     except Exception as e:
         print(f"❌ 헤더 확인 중 오류 발생: {e}")
 
     try:
-        pdf_files = [f for f in os.listdir(PDF_FOLDER_PATH) if f.lower().endswith('.pdf')]
-        if not pdf_files:
+        pdf_entries = list_pdf_files(PDF_FOLDER_PATH)
+        # 0바이트 PDF는 처리할 내용이 없고 mmap도 실패하므로 미리 제외
+        empty_files = [pdf_entry[0] for pdf_entry in pdf_entries if pdf_entry[1] == 0]
+        if empty_files:
+            print(f"⚠️ 빈(0바이트) PDF 파일 {len(empty_files)}개를 건너뜁니다: {empty_files}")
+            pdf_entries = [pdf_entry for pdf_entry in pdf_entries if pdf_entry[1] > 0]
+        if not pdf_entries:
             print(f"❌ '{PDF_FOLDER_PATH}' 폴더에 PDF 파일이 없습니다.")
             return
+        # 이전 실행에서 같은 스프레드시트에 기록을 마친 PDF(이름과 내용이 같은 파일)는 건너뜀
+        if SKIP_PROCESSED:
+            stat_keys, hashes_by_name = load_processed_files(spreadsheet.id)
+            skipped_count = len(pdf_entries)
+            pdf_entries = [pdf_entry for pdf_entry in pdf_entries if not is_processed(pdf_entry, stat_keys, hashes_by_name)]
+            skipped_count -= len(pdf_entries)
+            if skipped_count:
+                print(f"⏭️ 이미 처리된 PDF {skipped_count}개를 건너뜁니다.")
+            if not pdf_entries:
+                print("✅ 새로 처리할 PDF 파일이 없습니다.")
+                return
+        pdf_files = [pdf_entry[0] for pdf_entry in pdf_entries]
         print(f"\n📂 총 {len(pdf_files)}개의 PDF 파일을 처리합니다: {pdf_files}")
     except FileNotFoundError:
         print(f"❌ 폴더를 찾을 수 없습니다: '{PDF_FOLDER_PATH}'")
         return
 
-    for pdf_file in pdf_files:
-        try:
-            full_path = os.path.join(PDF_FOLDER_PATH, pdf_file)
-            
-            # 👇 [수정됨] 이제 결과는 JSON 객체의 '리스트'임
-            extracted_data_list = extract_data_with_gemini(
-                GCP_PROJECT_ID, GCP_LOCATION, full_path, GEMINI_PROMPT, creds
-            )
-            
-            # 👇 [수정됨] 추출된 데이터 리스트를 순회하며 각 행을 시트에 추가
-            rows_to_append = []
-            for i, extracted_data in enumerate(extracted_data_list):
-                file_name_to_log = pdf_file if i == 0 else "" # 첫 행에만 파일 이름 기록
+    all_rows = []
+    processed_files = set()
+    extraction_results = iter_extraction_results(pdf_files, creds)
+    try:
+        for pdf_file, result in extraction_results:
+            try:
+                # 👇 [수정됨] 이제 결과는 JSON 객체의 '리스트'임
+                if isinstance(result, Exception):
+                    raise result
+                extracted_data_list = result
+                
+                # 👇 [수정됨] 추출된 데이터 리스트를 순회하며 각 행을 시트에 추가
+                rows_to_append = [
+                    build_data_row(pdf_file if i == 0 else "", extracted_data) # 첫 행에만 파일 이름 기록
+                    for i, extracted_data in enumerate(extracted_data_list)
+                ]
+                if not rows_to_append:
+                    # 빈 결과는 처리 완료로 기록하지 않음 (다음 실행에서 다시 추출)
+                    print(f"⚠️ '{pdf_file}'에서 유효한 데이터를 찾지 못했습니다.")
+                    all_rows.append([pdf_file, "유효한 데이터 없음"])
+                    continue
+                
+                all_rows.extend(rows_to_append) # 모든 PDF의 행을 모아 마지막에 한 번에 추가
+                processed_files.add(pdf_file)
                 
-                data_row = [file_name_to_log]
-                for field in EXTRACTION_FIELDS:
-                    value = extracted_data.get(field, 'N/A')
-                    if isinstance(value, str):
-                        value = value.replace('\n', ' ')
-                    if field in currency_fields:
-                        value = clean_currency(str(value))
-                    data_row.append(value)
-                rows_to_append.append(data_row)
-            
-            if rows_to_append:
-                worksheet.append_rows(rows_to_append) # 여러 행을 한번에 추가하여 효율성 증대
-            
-            print(f"👍 '{pdf_file}' 처리 완료. {len(extracted_data_list)}개의 행을 스프레드시트에 추가했습니다.")
+                print(f"👍 '{pdf_file}' 처리 완료. {len(extracted_data_list)}개의 행을 준비했습니다.")
 
+            except Exception as e:
+                print(f"🚨 '{pdf_file}' 처리 중 오류 발생: {e}")
+                # 오류 발생 시 시트에 기록
+                all_rows.append([pdf_file, f"오류 발생: {e}"])
+                continue
+    finally:
+        # 중단(Ctrl-C 등)되더라도 지금까지 처리한 결과는 저장 (남은 PDF 요청은 먼저 취소)
+        extraction_results.close()
+        try:
+            flush_rows(worksheet, all_rows)
+            mark_processed_files(spreadsheet.id, [pdf_entry for pdf_entry in pdf_entries if pdf_entry[0] in processed_files])
         except Exception as e:
-            print(f"🚨 '{pdf_file}' 처리 중 오류 발생: {e}")
-            # 오류 발생 시 시트에 기록
-            worksheet.append_row([pdf_file, f"오류 발생: {e}"])
-            continue
+            print(f"❌ 스프레드시트 기록 중 오류 발생: {e}")
+
+    if _routing_stats["total"]:
+        upgrade_ratio = _routing_stats["upgraded"] / _routing_stats["total"]
+        print(f"\n🔼 {FALLBACK_MODEL_NAME}로 다시 추출한 파일: {_routing_stats['upgraded']}/{_routing_stats['total']}개 ({upgrade_ratio:.0%})")
 
     print("\n--- ✨ 모든 작업이 완료되었습니다 ---")
 
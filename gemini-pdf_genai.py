@@ -1,11 +1,35 @@
 import os
 import re
 import json
+import time
+import hashlib
+import tempfile
+import random
+import functools
+import threading
+from datetime import datetime as _dt, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import gspread
 from google.oauth2 import service_account
+from google.api_core import exceptions as google_exceptions
+from googleapiclient.errors import HttpError  # genai.upload_file(File API)은 discovery 클라이언트를 사용
 import google.generativeai as genai
+from google.generativeai import caching
 from dotenv import load_dotenv
 
+try:
+    import fitz  # PyMuPDF (선택 사항: 텍스트 레이어가 있는 PDF는 비전 처리를 생략)
+except ImportError:
+    fitz = None
+
+try:
+    import orjson  # 선택 사항: 긴 응답의 JSON 파싱 속도 향상
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError는 json.JSONDecodeError의 하위 클래스이므로 기존 except 절을 그대로 사용
+_json_loads = orjson.loads if orjson is not None else json.loads
+
 load_dotenv()
 
 # --- ⚙️ 1. 사용자 설정 ---
@@ -13,6 +37,21 @@ API_KEY = os.getenv("GOOGLE_API_KEY")  # .env 파일에서 API 키 가져오기
 SERVICE_ACCOUNT_FILE = 'pdf-ocr.json'
 SPREADSHEET_NAME = 'pdf-ocr'
 PDF_FOLDER_PATH = './pdfs/'
+MAX_WORKERS = int(os.getenv("PDF_OCR_CONCURRENCY", "8"))  # 동시에 처리할 PDF 수 (.env의 PDF_OCR_CONCURRENCY로 변경 가능)
+MODEL_NAME = "gemini-2.5-flash"
+PDF_HANDLING = "vision"  # "vision": 항상 PDF 전송 (표 구조 유지, 권장), "auto": 텍스트 레이어가 충분하면 텍스트로 전송, "text": 항상 텍스트로 전송
+MIN_TEXT_CHARS_PER_PAGE = 200  # "auto" 모드에서 텍스트 레이어로 인정할 페이지당 최소 글자 수
+MIN_TEXT_PAGE_RATIO = 0.8      # "auto" 모드에서 텍스트가 있어야 하는 페이지 비율
+USE_CACHE = True                 # 같은 PDF + 프롬프트 + 모델 조합의 추출 결과를 디스크에 캐시
+CACHE_DIR = './.gemini_cache/'
+SHEET_STATE_FILE = './.sheet_state.json'  # 헤더 확인 결과 저장 (시트를 비웠다면 이 파일을 삭제)
+PROCESSED_STATE_FILE = './.processed.txt'  # 스프레드시트별로 기록을 마친 PDF 목록과 sha256 (전체를 다시 처리하려면 이 파일을 삭제)
+SKIP_PROCESSED = True  # 이전 실행에서 기록을 마친 PDF는 건너뜀
+USE_PROMPT_CACHE = True  # 고정 프롬프트를 Gemini 컨텍스트 캐시에 올려 요청마다 다시 보내지 않음
+PROMPT_CACHE_TTL = timedelta(hours=1)   # 실행 중에는 TTL의 절반이 지날 때마다 연장
+PROMPT_CACHE_MIN_TOKENS = 1024          # 컨텍스트 캐시 최소 토큰 수 (gemini-2.5-flash 기준). 프롬프트가 이보다 짧으면 캐시를 만들지 않음
+INLINE_PDF_MAX_BYTES = 15 * 1024 * 1024  # 이보다 작은 PDF는 File API 업로드 없이 요청에 직접 포함
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))  # 분당 최대 Gemini 요청 수 (업로드 + 생성, 0이면 제한 없음)
 
 # --- 🤖 2. 추출 필드 및 프롬프트 ---
 EXTRACTION_FIELDS = [
@@ -25,8 +64,6 @@ EXTRACTION_FIELDS = [
     "수입금액", "일반", "자가", "일반(기본)", "자가(초과)"
 ]
 
-json_example = "[\n" + "  {\n" + ",\n".join([f'    "{field}": "값"' for field in EXTRACTION_FIELDS]) + "\n  },\n  {\n" + ",\n".join([f'    "{field}": "값2"' for field in EXTRACTION_FIELDS]) + "\n  }\n]"
-
 GEMINI_PROMPT = f"""
 ## 역할
 당신은 주어진 문서 전체를 종합적으로 분석하여, 여러 다른 위치와 형식의 표나 텍스트에서 데이터를 정확히 추출하고 구조화된 JSON으로 변환하는 OCR 전문가입니다.
@@ -60,144 +97,661 @@ GEMINI_PROMPT = f"""
 - **모든 사업소득 행을 찾아 각각 별도의 JSON 객체로 만드세요**
 - 하나의 문서에 여러 사업소득이 있다면, 그 수만큼 JSON 객체가 생성되어야 합니다
 
-### 추출할 항목
-{', '.join(EXTRACTION_FIELDS)}
-
-### 출력 형식 (여러 행이 있을 경우의 예시)
-{json_example}
+### 출력 형식
+다음 키를 가진 객체들의 JSON 배열로 응답하세요: {', '.join(EXTRACTION_FIELDS)}
 
 **반드시 JSON 배열 형태로만 응답하고, 다른 설명은 추가하지 마세요.**
 """
 
+# --- 📐 응답 스키마 (JSON 모드) ---
+RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {field: {"type": "STRING"} for field in EXTRACTION_FIELDS},
+        "required": EXTRACTION_FIELDS,
+    },
+}
+GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=RESPONSE_SCHEMA,
+    temperature=0,
+)
+
 # --- 💰 숫자 정제 대상 필드 ---
 currency_fields = [
     "중간예납세액", "원천징수세액", "국민연금보험료", "개인연금저축",
     "소기업소상공인공제부금 (노란우산공제)", "퇴직연금세액공제", "연금계좌세액공제", "수입금액"
 ]
+# 행 생성 시 반복 조회되는 필드 목록과 집합은 한 번만 생성
+_FIELDS = tuple(EXTRACTION_FIELDS)
+_CURRENCY_SET = frozenset(currency_fields)
+_NL_TABLE = str.maketrans({"\n": " ", "\r": " "})
+
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"  # 오류 로그 시트의 처리 시간 형식
 
 # --- 🔧 유틸리티 함수 ---
+# 자주 호출되는 정규식과 테이블은 모듈 로드 시 한 번만 생성
+_EMPTY_VALUES = frozenset(["", "없음", "N/A"])
+_NON_DIGIT_RE = re.compile(r"[^\d]")
+_ASCII_NON_DIGITS = "".join(chr(c) for c in range(128) if not chr(c).isdigit())
+_DIGITS_ONLY_TABLE = str.maketrans("", "", _ASCII_NON_DIGITS)
+
 def clean_currency(value: str) -> str:
     if not isinstance(value, str): return "0"
-    if value.strip() in ["", "없음", "N/A"]: return "0"
-    cleaned = re.sub(r"[^\d]", "", value)
+    if value.strip() in _EMPTY_VALUES: return "0"
+    # ASCII 문자열은 정규식 대신 str.translate로 숫자만 남김 (한글 등 비ASCII는 정규식 사용)
+    cleaned = value.translate(_DIGITS_ONLY_TABLE) if value.isascii() else _NON_DIGIT_RE.sub("", value)
     return cleaned if cleaned else "0"
 
+# --- 🔁 재시도(지수 백오프) 설정 ---
+MAX_API_RETRIES = 6          # 최초 호출 포함 최대 시도 횟수
+BACKOFF_MAX_SECONDS = 60     # 재시도 간 최대 대기 시간(초)
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.ResourceExhausted,   # 429 (할당량 초과)
+    google_exceptions.TooManyRequests,     # 429
+    google_exceptions.ServiceUnavailable,  # 503
+    google_exceptions.DeadlineExceeded,    # 504
+    google_exceptions.InternalServerError, # 500
+)
+RETRYABLE_HTTP_STATUS = {429, 500, 503}
+_RATE_LIMIT_MESSAGE_RE = re.compile(r"\b429\b|quota|rate limit", re.IGNORECASE)
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """
+    요청 한도 초과(429/할당량) 오류인지 확인합니다. Google API 오류만 대상으로 하며,
+    HTTP 상태 코드가 있으면 코드로만 판단하고 코드가 없을 때만 메시지를 확인합니다.
+    """
+    if isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return True
+    if isinstance(e, google_exceptions.GoogleAPICallError):
+        status_code, message = e.code, e.message
+    elif isinstance(e, gspread.exceptions.APIError):
+        status_code, message = getattr(e.response, "status_code", None), str(e)
+    elif isinstance(e, HttpError):
+        status_code, message = getattr(e.resp, "status", None), str(e)
+    else:
+        return False  # 파일 경로 등에 "429"가 들어간 일반 예외는 재시도하지 않음
+    if status_code is not None:
+        return status_code == 429
+    return bool(_RATE_LIMIT_MESSAGE_RE.search(message or ""))
+
+def is_retryable_error(e: Exception) -> bool:
+    """
+    재시도하면 해결될 수 있는 일시적인 오류(429, 5xx)인지 확인합니다.
+    """
+    if isinstance(e, RETRYABLE_EXCEPTIONS) or is_rate_limit_error(e):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        return getattr(e.response, "status_code", None) in RETRYABLE_HTTP_STATUS
+    if isinstance(e, HttpError):
+        return getattr(e.resp, "status", None) in RETRYABLE_HTTP_STATUS
+    return False
+
+def get_server_retry_delay(e: Exception):
+    """
+    서버가 지정한 재시도 대기 시간(초)을 반환합니다. 없으면 None을 반환합니다.
+    """
+    # Gemini/Vertex: RetryInfo.retry_delay
+    for detail in getattr(e, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(e))
+    if match:
+        return float(match.group(1))
+    # Sheets API: Retry-After 헤더, File API(HttpError): httplib2 응답의 retry-after 헤더
+    if isinstance(e, HttpError):
+        retry_after = (e.resp or {}).get("retry-after")
+    else:
+        response = getattr(e, "response", None)
+        retry_after = getattr(response, "headers", {}).get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return None
+
+def call_with_backoff(func, *args, **kwargs):
+    """
+    일시적인 API 오류 발생 시 지수 백오프(2^n + 지터)로 재시도하며 함수를 호출합니다.
+    """
+    for attempt in range(MAX_API_RETRIES):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == MAX_API_RETRIES - 1 or not is_retryable_error(e):
+                raise
+            delay = get_server_retry_delay(e)
+            if delay is None:
+                delay = min(BACKOFF_MAX_SECONDS, 2 ** attempt + random.uniform(0, 1))
+            print(f"⏳ 일시적인 API 오류({type(e).__name__}). {delay:.1f}초 후 재시도합니다... ({attempt + 1}/{MAX_API_RETRIES - 1})")
+            time.sleep(delay)
+
+class RateLimiter:
+    """
+    요청 사이에 최소 간격(60 / RPM초)을 두어 분당 요청 수를 제한합니다. 여러 스레드에서 공유합니다.
+    """
+    def __init__(self, rpm: int):
+        self.min_interval = 60 / rpm if rpm > 0 else 0
+        self.lock = threading.Lock()
+        self.last_call_ts = 0.0
+
+    def acquire(self):
+        if not self.min_interval:
+            return
+        with self.lock:
+            wait = self.min_interval - (time.monotonic() - self.last_call_ts)
+            if wait > 0:
+                time.sleep(wait)
+            self.last_call_ts = time.monotonic()
+
+gemini_rate_limiter = RateLimiter(GEMINI_RPM)
+
+def flush_rows(worksheet, rows):
+    """
+    모아둔 행들을 한 번의 API 호출로 시트에 추가합니다.
+    """
+    if not rows:
+        return
+    print(f"\n📤 {len(rows)}개의 행을 스프레드시트에 한 번에 기록합니다...")
+    # RAW: 서버 측 수식 해석을 건너뜀
+    call_with_backoff(worksheet.append_rows, rows, value_input_option='RAW', insert_data_option='INSERT_ROWS')
+
+def build_data_row(file_name_to_log, row_number, extracted_data):
+    """
+    추출된 JSON 객체 하나를 시트에 기록할 행으로 변환합니다.
+    """
+    data_row = [file_name_to_log, row_number]
+    data_row.extend(
+        clean_currency(str(value)) if field in _CURRENCY_SET
+        else value.translate(_NL_TABLE) if isinstance(value, str)
+        else str(value)
+        for field, value in ((field, extracted_data.get(field, 'N/A')) for field in _FIELDS)
+    )
+    return data_row
+
+def load_sheet_state() -> dict:
+    """
+    스프레드시트 상태 파일(.sheet_state.json)을 읽습니다.
+    """
+    try:
+        with open(SHEET_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_sheet_state(state: dict):
+    with open(SHEET_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+
+def ensure_headers(spreadsheet, worksheet, headers):
+    """
+    시트 1행에 헤더가 없으면 추가합니다. 이전 실행에서 같은 헤더를 확인했다면 API 호출을 생략합니다.
+    """
+    headers_hash = hashlib.md5("\t".join(headers).encode("utf-8")).hexdigest()
+    sheet_state = load_sheet_state()
+    if sheet_state.get(spreadsheet.id, {}).get("headers_hash") == headers_hash:
+        print("📝 헤더가 이미 존재합니다. (저장된 상태 사용)")
+        return
+
+    first_row = worksheet.row_values(1)
+    if not first_row:
+        print("📝 1행이 비어있어 헤더를 추가합니다...")
+        call_with_backoff(worksheet.append_row, headers)
+    else:
+        print("📝 헤더가 이미 존재합니다.")
+
+    sheet_state[spreadsheet.id] = {"headers_written": True, "headers_hash": headers_hash}
+    save_sheet_state(sheet_state)
+
+def list_pdf_files(folder_path: str):
+    """
+    폴더의 PDF 파일을 (이름, 크기, 수정 시각) 목록으로 반환합니다. 작은 파일부터 처리하도록 크기순으로 정렬합니다.
+    """
+    pdf_entries = []
+    with os.scandir(folder_path) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith('.pdf'):
+                stat = entry.stat()  # scandir가 이미 조회한 정보를 재사용
+                pdf_entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    pdf_entries.sort(key=lambda pdf_entry: pdf_entry[1])
+    return pdf_entries
+
+def _stat_key(pdf_entry) -> str:
+    return "\t".join(str(value) for value in pdf_entry)
+
+def file_sha256(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        hasher = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+def load_processed_files(spreadsheet_id: str):
+    """
+    이전 실행에서 이 스프레드시트에 기록을 마친 PDF 목록을 읽습니다. (.sheet_state.json처럼 spreadsheet.id 기준)
+    (이름, 크기, 수정 시각) 키 집합과 파일 이름별 sha256 집합을 반환합니다.
+    """
+    stat_keys, hashes_by_name = set(), {}
+    try:
+        with open(PROCESSED_STATE_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 5 or parts[0] != spreadsheet_id:
+                    continue
+                stat_keys.add("\t".join(parts[1:4]))
+                hashes_by_name.setdefault(parts[1], set()).add(parts[4])
+    except FileNotFoundError:
+        pass
+    return stat_keys, hashes_by_name
+
+def is_processed(pdf_entry, stat_keys, hashes_by_name) -> bool:
+    """
+    크기와 수정 시각이 같으면 바로 처리된 것으로 보고, 다르면 내용(sha256)을 비교합니다.
+    """
+    if _stat_key(pdf_entry) in stat_keys:
+        return True
+    known_hashes = hashes_by_name.get(pdf_entry[0])
+    if not known_hashes:
+        return False  # 한 번도 기록된 적 없는 파일은 해시를 계산하지 않음
+    return file_sha256(os.path.join(PDF_FOLDER_PATH, pdf_entry[0])) in known_hashes
+
+def mark_processed_files(spreadsheet_id: str, pdf_entries):
+    """
+    이 스프레드시트에 기록을 마친 PDF를 sha256과 함께 상태 파일에 추가합니다.
+    """
+    if not pdf_entries:
+        return
+    with open(PROCESSED_STATE_FILE, "a", encoding="utf-8") as f:
+        for pdf_entry in pdf_entries:
+            sha256 = file_sha256(os.path.join(PDF_FOLDER_PATH, pdf_entry[0]))
+            f.write(f"{spreadsheet_id}\t{_stat_key(pdf_entry)}\t{sha256}\n")
+
+def try_text_extract(file_path: str, check_coverage: bool = True):
+    """
+    PyMuPDF로 PDF의 텍스트 레이어를 추출합니다. 텍스트가 충분하지 않으면 None을 반환합니다.
+    """
+    if fitz is None:
+        return None
+    try:
+        with fitz.open(file_path) as doc:
+            # 표의 셀 구분이 유지되도록 블록(셀) 단위로 읽기 순서대로 추출하고, 블록 사이는 빈 줄로 구분
+            page_texts = [
+                "\n\n".join(block[4].strip() for block in page.get_text("blocks", sort=True) if block[6] == 0)
+                for page in doc
+            ]
+    except Exception as e:
+        print(f"⚠️ '{os.path.basename(file_path)}' PDF 텍스트 추출 실패: {e}")
+        return None
+
+    text = "\n".join(page_texts).strip()
+    if not text:
+        return None
+    if check_coverage:
+        # 스캔본처럼 텍스트 레이어가 부실한 PDF는 비전 처리로 보냄
+        pages_with_text = sum(1 for page_text in page_texts if page_text.strip())
+        if pages_with_text / len(page_texts) < MIN_TEXT_PAGE_RATIO:
+            return None
+        if len(text) / len(page_texts) < MIN_TEXT_CHARS_PER_PAGE:
+            return None
+    return text
+
+def get_document_text(file_path: str):
+    """
+    PDF_HANDLING 설정에 따라 PDF 대신 전송할 텍스트를 반환합니다. 비전 처리가 필요하면 None을 반환합니다.
+    """
+    if PDF_HANDLING == "vision":
+        return None
+    text = try_text_extract(file_path, check_coverage=(PDF_HANDLING == "auto"))
+    if text is None and PDF_HANDLING == "text":
+        raise ValueError("PDF에서 텍스트를 추출하지 못했습니다. (PyMuPDF 설치 여부 또는 텍스트 레이어를 확인하세요)")
+    if text is not None:
+        print(f"📝 '{os.path.basename(file_path)}': PDF 텍스트 레이어를 사용합니다. (비전 처리 생략)")
+    return text
+
+def build_document_text_section(document_text: str) -> str:
+    return (
+        "## 문서 텍스트\n"
+        "아래는 PDF 이미지 대신 텍스트 레이어에서 추출한 내용입니다. 지침의 '이미지'와 '셀'은 이 텍스트를 가리킵니다.\n"
+        "표의 각 셀은 빈 줄로 구분된 블록이며, 한 블록 안에서 여러 줄로 나뉜 텍스트는 하나의 셀 값입니다.\n\n"
+        f"{document_text}"
+    )
+
+def build_text_prompt(prompt: str, document_text: str) -> str:
+    return f"{prompt}\n\n{build_document_text_section(document_text)}"
+
+def make_cache_key(pdf_bytes: bytes, prompt: str, model_name: str) -> str:
+    """
+    PDF 내용, 프롬프트, 모델 이름으로 캐시 키(SHA-256)를 만듭니다.
+    """
+    hasher = hashlib.sha256(pdf_bytes)
+    hasher.update(prompt.encode("utf-8"))
+    hasher.update(model_name.encode("utf-8"))
+    return hasher.hexdigest()
+
+def load_cached_response(cache_key: str):
+    """
+    디스크 캐시에 저장된 추출 결과를 반환합니다. 없으면 None을 반환합니다.
+    """
+    if not USE_CACHE:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, f"{cache_key}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["response"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return None
+
+def save_cached_response(cache_key: str, response, model_name: str, prompt: str):
+    """
+    추출 결과를 디스크 캐시에 저장합니다. (임시 파일에 쓴 뒤 os.replace로 원자적으로 교체)
+    """
+    if not USE_CACHE:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entry = {
+        "response": response,
+        "model": model_name,
+        "prompt_hash": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+    }
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(CACHE_DIR, f"{cache_key}.json"))
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+_CLOSING_BRACKETS = {"[": "]", "{": "}"}
+
+def _balanced_json_span(text: str):
+    """
+    첫 '[' 또는 '{'부터 괄호 짝이 맞는 구간을 한 번의 순회로 찾습니다. (문자열 안의 괄호와 이스케이프는 무시)
+    (구간, 잘림 여부)를 반환합니다. 응답이 중간에 잘렸다면 열린 문자열과 괄호를 닫은 구간과 True를 반환하며,
+    이 경우 마지막 행의 값이 빠져 있으므로 호출하는 쪽에서 실패로 처리해야 합니다.
+    """
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if not starts:
+        return None, False
+    start = min(starts)
+    stack = []
+    in_str = False
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c in _CLOSING_BRACKETS:
+            stack.append(_CLOSING_BRACKETS[c])
+        elif c == "]" or c == "}":
+            if stack.pop() != c:
+                return None, False  # 괄호 짝이 맞지 않음
+            if not stack:
+                return text[start:i + 1], False
+    # 잘린 응답: 열린 문자열과 괄호를 순서대로 닫음
+    return text[start:] + ('"' if in_str else "") + "".join(reversed(stack)), True
+
+def _as_json_list(json_data):
+    # 배열이 아닌 경우 배열로 변환하고, 객체의 리스트가 아니면 None
+    if isinstance(json_data, dict):
+        return [json_data]
+    if isinstance(json_data, list) and all(isinstance(item, dict) for item in json_data):
+        return json_data
+    return None
+
 def safe_extract_json(text):
     """
     텍스트에서 JSON 배열을 안전하게 추출하는 함수
+    (1) 전체 파싱 → (2) 앞뒤 마크다운 코드 블록 제거 → (3) 첫 번째 균형 잡힌 [...] / {...} 구간
+    응답이 중간에 잘렸다면 일부 행만 남으므로 None을 반환해 다시 요청하도록 합니다.
     """
-    # 여러 패턴으로 JSON 찾기 시도
-    patterns = [
-        r'\[[\s\S]*?\]',  # JSON 배열 (가장 우선)
-        r'```json\s*([\s\S]*?)\s*```',  # 마크다운 JSON 블록
-        r'```\s*([\s\S]*?)\s*```',  # 일반 마크다운 블록
-        r'\{[\s\S]*?\}',  # JSON 객체 (단일)
-    ]
-    
-    for pattern in patterns:
-        matches = re.findall(pattern, text, re.DOTALL)
-        for match in matches:
-            try:
-                # 마크다운 패턴의 경우
-                if '```' in pattern and isinstance(match, str):
-                    json_data = json.loads(match.strip())
-                else:
-                    json_data = json.loads(match)
-                
-                # 배열이 아닌 경우 배열로 변환
-                if isinstance(json_data, dict):
-                    return [json_data]
-                elif isinstance(json_data, list):
-                    return json_data
-                    
-            except json.JSONDecodeError:
-                continue
-    
-    return None
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[3:]
+        if text[:4].lower() == "json":
+            text = text[4:]
+        if text.endswith("```"):
+            text = text[:-3]
+        text = text.strip()
+    # 대부분의 응답은 JSON 자체이므로 스캔 없이 바로 파싱
+    if text.startswith(("[", "{")):
+        try:
+            return _as_json_list(_json_loads(text))
+        except json.JSONDecodeError:
+            pass
+
+    span, truncated = _balanced_json_span(text)
+    if span is None:
+        return None
+    if truncated:
+        return None  # 호출하는 쪽에서 파일 이름과 함께 실패를 출력
+    try:
+        return _as_json_list(_json_loads(span))
+    except json.JSONDecodeError:
+        return None
+
+@functools.lru_cache(maxsize=None)
+def get_model(model_name: str, cached_content_name: str = None):
+    """
+    GenerativeModel 인스턴스를 한 번만 만들어 모든 파일과 스레드에서 재사용합니다.
+    cached_content_name이 있으면 해당 컨텍스트 캐시(프롬프트)를 사용하는 모델을 만듭니다.
+    """
+    if cached_content_name is not None:
+        return genai.GenerativeModel.from_cached_content(cached_content=cached_content_name, generation_config=GENERATION_CONFIG)
+    return genai.GenerativeModel(model_name=model_name, generation_config=GENERATION_CONFIG)
+
+_prompt_cache = None  # main()에서 생성한 프롬프트 컨텍스트 캐시 (없으면 요청마다 프롬프트 전송)
+_prompt_cache_refreshed_at = 0.0
+
+def create_prompt_cache(prompt: str):
+    """
+    프롬프트를 시스템 안내로 하는 컨텍스트 캐시를 만듭니다.
+    프롬프트가 캐시 최소 토큰 수보다 짧거나 생성에 실패하면 None을 반환합니다.
+    """
+    global _prompt_cache_refreshed_at
+    if not USE_PROMPT_CACHE:
+        return None
+    try:
+        token_count = get_model(MODEL_NAME).count_tokens(prompt).total_tokens
+        if token_count < PROMPT_CACHE_MIN_TOKENS:
+            print(f"ℹ️ 프롬프트({token_count}토큰)가 컨텍스트 캐시 최소 토큰 수({PROMPT_CACHE_MIN_TOKENS})보다 짧아 캐시를 사용하지 않습니다.")
+            return None
+        prompt_cache = caching.CachedContent.create(
+            model=f"models/{MODEL_NAME}",
+            system_instruction=prompt,
+            ttl=PROMPT_CACHE_TTL,
+        )
+    except Exception as e:
+        print(f"⚠️ 프롬프트 캐시를 만들지 못해 요청마다 프롬프트를 전송합니다: {e}")
+        return None
+    _prompt_cache_refreshed_at = time.monotonic()
+    print("🗂️ 프롬프트를 Gemini 컨텍스트 캐시에 저장했습니다.")
+    return prompt_cache
+
+def refresh_prompt_cache():
+    """
+    실행이 TTL보다 길어져도 캐시가 만료되지 않도록, TTL의 절반이 지나면 만료 시간을 연장합니다.
+    """
+    global _prompt_cache_refreshed_at
+    prompt_cache = _prompt_cache
+    if prompt_cache is None or time.monotonic() - _prompt_cache_refreshed_at < PROMPT_CACHE_TTL.total_seconds() / 2:
+        return
+    try:
+        prompt_cache.update(ttl=PROMPT_CACHE_TTL)
+        _prompt_cache_refreshed_at = time.monotonic()
+    except Exception as e:
+        print(f"⚠️ 프롬프트 캐시 만료 시간 연장 중 오류: {e}")
+
+def disable_prompt_cache():
+    """
+    캐시가 만료되는 등 사용할 수 없게 되면 이후 요청은 프롬프트를 직접 전송합니다.
+    """
+    global _prompt_cache
+    _prompt_cache = None
+    get_model.cache_clear()
+
+def delete_prompt_cache(prompt_cache):
+    if prompt_cache is None:
+        return
+    try:
+        prompt_cache.delete()
+    except Exception as e:
+        print(f"⚠️ 프롬프트 캐시 삭제 중 오류: {e}")
+
+# 업로드 파일 삭제는 결과와 무관하므로 백그라운드에서 처리 (main() 종료 시 완료를 기다림)
+_cleanup_executor = ThreadPoolExecutor(max_workers=2)
+
+def delete_uploaded_file(uploaded_file):
+    try:
+        print(f"🗑️ 업로드된 파일 '{uploaded_file.display_name}'을 삭제합니다.")
+        call_with_backoff(genai.delete_file, uploaded_file.name)
+    except Exception as e:
+        print(f"⚠️ 파일 삭제 중 오류: {e}")
+
+def request_extraction(file_path: str, pdf_bytes: bytes, document_text, request_prompt: str) -> str:
+    """
+    PDF 업로드 → 생성 요청 → 업로드 파일 삭제를 한 번 수행하고 응답 텍스트를 반환합니다.
+    재시도할 때마다 새로 업로드하도록 업로드/삭제 과정 전체를 하나의 단위로 묶습니다.
+    """
+    file_name = os.path.basename(file_path)
+    uploaded_file = None
+    try:
+        # 1. 모델 초기화 (캐시된 프롬프트가 있으면 문서 내용만 전송)
+        prompt_cache = _prompt_cache
+        if prompt_cache is not None:
+            model = get_model(MODEL_NAME, prompt_cache.name)
+            prompt_parts = [] if document_text is None else [build_document_text_section(document_text)]
+        else:
+            model = get_model(MODEL_NAME)
+            prompt_parts = [request_prompt]
+
+        # 2. 요청 내용 준비 (텍스트 레이어, 인라인 PDF 또는 File API로 업로드한 PDF)
+        if document_text is not None:
+            contents = prompt_parts
+        elif len(pdf_bytes) < INLINE_PDF_MAX_BYTES:
+            # 작은 PDF는 업로드/삭제 왕복 없이 요청에 직접 포함
+            contents = [{"mime_type": "application/pdf", "data": pdf_bytes}] + prompt_parts
+        else:
+            print(f"☁️ '{file_name}': File API로 PDF 파일을 업로드합니다...")
+            gemini_rate_limiter.acquire()
+            uploaded_file = genai.upload_file(path=file_path, display_name=os.path.basename(file_path))
+            contents = [uploaded_file] + prompt_parts
+
+        # 3. 콘텐츠 생성 요청
+        print(f"🧠 '{file_name}': Gemini에게 데이터 추출을 요청합니다...")
+        gemini_rate_limiter.acquire()
+        try:
+            return model.generate_content(contents).text
+        except google_exceptions.NotFound:
+            if prompt_cache is None:
+                raise
+            # 캐시가 만료/삭제된 경우: 캐시를 끄고 프롬프트를 직접 보내 다시 요청
+            print(f"⚠️ '{file_name}': 프롬프트 캐시를 찾을 수 없어 프롬프트를 직접 전송합니다.")
+            disable_prompt_cache()
+            return request_extraction(file_path, pdf_bytes, document_text, request_prompt)
+    finally:
+        # 4. 처리 후 업로드된 파일 삭제 (응답을 기다리지 않음)
+        if uploaded_file:
+            _cleanup_executor.submit(delete_uploaded_file, uploaded_file)
 
 def extract_data_with_gemini(file_path: str, prompt: str):
     """
     Google Generative AI SDK를 사용하여 PDF에서 데이터를 추출합니다.
     """
-    print(f"\n📄 '{os.path.basename(file_path)}' 파일 처리 시작...")
-    
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"오류: PDF 파일을 찾을 수 없습니다. 경로: {file_path}")
+    file_name = os.path.basename(file_path)
+    print(f"\n📄 '{file_name}' 파일 처리 시작...")
+
+    # 텍스트 레이어가 있는 PDF는 업로드 없이 텍스트만 전송 (비전 처리 생략)
+    document_text = get_document_text(file_path)
+    request_prompt = build_text_prompt(prompt, document_text) if document_text is not None else prompt
+
+    # 같은 PDF + 프롬프트 + 모델 조합은 캐시된 결과를 재사용
+    with open(file_path, "rb") as f:
+        pdf_bytes = f.read()
+    cache_key = make_cache_key(pdf_bytes, request_prompt, MODEL_NAME)
+    cached_data = _as_json_list(load_cached_response(cache_key))
+    if cached_data is not None:
+        print(f"💾 '{file_name}': 캐시된 추출 결과를 사용합니다.")
+        return cached_data
 
-    uploaded_file = None
     max_retries = 3
-    
+
     for attempt in range(max_retries):
+        print(f"🔄 '{file_name}': 시도 {attempt + 1}/{max_retries}")
+        # 요청 한도 초과 등 일시적 오류는 업로드부터 다시 수행하며 백오프 재시도
+        response_text = call_with_backoff(request_extraction, file_path, pdf_bytes, document_text, request_prompt)
+
+        print(f"📝 '{file_name}': 응답 받음 (시도 {attempt + 1}/{max_retries}, 응답 길이: {len(response_text)} 문자)")
+
+        # JSON 모드 응답은 바로 파싱하고, 형식이 깨진 경우에만 복구 로직 사용 (두 경로 모두 객체 리스트로 정규화)
         try:
-            print(f"🔄 시도 {attempt + 1}/{max_retries}")
-            
-            # 1. File API를 사용해 파일 업로드
-            print("☁️ File API로 PDF 파일을 업로드합니다...")
-            uploaded_file = genai.upload_file(path=file_path, display_name=os.path.basename(file_path))
-            
-            # 2. 모델 초기화 및 콘텐츠 생성 요청
-            model = genai.GenerativeModel(model_name="gemini-2.5-flash")
-            
-            print("🧠 Gemini에게 데이터 추출을 요청합니다...")
-            response = model.generate_content([uploaded_file, prompt])
-            
-            print(f"📝 응답 받음 (시도 {attempt + 1}/{max_retries})")
-            print(f"응답 길이: {len(response.text)} 문자")
-            
-            # 3. 안전한 JSON 추출
-            extracted_data = safe_extract_json(response.text)
-            
-            if extracted_data is None:
-                print(f"⚠️ 시도 {attempt + 1}: JSON 추출 실패")
-                print(f"응답 미리보기: {response.text[:500]}...")
-                if attempt < max_retries - 1:
-                    continue
-                else:
-                    raise ValueError(f"모든 시도에서 JSON 추출 실패. 원본 응답:\n{response.text}")
-            
-            print(f"✅ 데이터 추출 완료. {len(extracted_data)}개 항목 발견")
-            return extracted_data
-            
-        except Exception as e:
-            print(f"❌ 시도 {attempt + 1} 실패: {e}")
-            if attempt == max_retries - 1:
-                raise
-        finally:
-            # 4. 처리 후 업로드된 파일 삭제
-            if uploaded_file:
-                try:
-                    print(f"🗑️ 업로드된 파일 '{uploaded_file.display_name}'을 삭제합니다.")
-                    genai.delete_file(uploaded_file.name)
-                    uploaded_file = None
-                except Exception as e:
-                    print(f"⚠️ 파일 삭제 중 오류: {e}")
+            extracted_data = _as_json_list(_json_loads(response_text))
+        except json.JSONDecodeError:
+            extracted_data = safe_extract_json(response_text)
 
-def validate_and_fix_data(data_list):
+        if extracted_data is None:
+            print(f"⚠️ '{file_name}': 시도 {attempt + 1} JSON 추출 실패")
+            print(f"   응답 미리보기: {response_text[:500]}...")
+            if attempt < max_retries - 1:
+                continue
+            raise ValueError(f"모든 시도에서 JSON 추출 실패. 원본 응답:\n{response_text}")
+
+        save_cached_response(cache_key, extracted_data, MODEL_NAME, request_prompt)
+        print(f"✅ '{file_name}': 데이터 추출 완료. {len(extracted_data)}개 항목 발견")
+        return extracted_data
+
+def validate_and_fix_data(data_list, file_name: str):
     """
     추출된 데이터의 유효성을 검사하고 수정
     """
     if not isinstance(data_list, list):
-        print("⚠️ 데이터가 배열이 아닙니다. 배열로 변환합니다.")
+        print(f"⚠️ '{file_name}': 데이터가 배열이 아닙니다. 배열로 변환합니다.")
         return [data_list] if isinstance(data_list, dict) else []
     
     validated_data = []
     for i, item in enumerate(data_list):
         if not isinstance(item, dict):
-            print(f"⚠️ 항목 {i+1}이 객체가 아닙니다. 건너뜁니다.")
+            print(f"⚠️ '{file_name}': 항목 {i+1}이 객체가 아닙니다. 건너뜁니다.")
             continue
         
-        # 모든 필드가 있는지 확인하고 없으면 추가
-        for field in EXTRACTION_FIELDS:
-            if field not in item:
-                item[field] = "N/A"
-        
-        validated_data.append(item)
+        # 모든 필드가 있는지 확인하고 없으면 "N/A"로 채움 (필드 순서대로 한 번에 재구성)
+        validated_data.append({field: item.get(field, "N/A") for field in _FIELDS})
     
-    print(f"✅ 데이터 검증 완료. {len(validated_data)}개 항목 유효")
+    print(f"✅ '{file_name}': 데이터 검증 완료. {len(validated_data)}개 항목 유효")
     return validated_data
 
+def process_one(pdf_file: str):
+    """
+    PDF 하나를 추출·검증해 스프레드시트 행으로 만듭니다. (작업 스레드에서 실행)
+    (pdf_file, rows_to_append, error)를 반환하며, 예외는 error로 전달합니다.
+    """
+    try:
+        extracted_data_list = extract_data_with_gemini(os.path.join(PDF_FOLDER_PATH, pdf_file), GEMINI_PROMPT)
+
+        # 데이터 검증 및 수정
+        validated_data = validate_and_fix_data(extracted_data_list, pdf_file)
+
+        # 스프레드시트에 추가할 행들 준비
+        # 첫 번째 행에만 파일 이름 표시, 나머지는 빈 문자열
+        rows_to_append = [
+            build_data_row(pdf_file if i == 0 else "", i + 1, extracted_data)
+            for i, extracted_data in enumerate(validated_data)
+        ]
+        return pdf_file, rows_to_append, None
+    except Exception as e:
+        return pdf_file, [], e
+
 # --- 🚀 Main ---
 def main():
+    global _prompt_cache
     print("--- 🚀 PDF 일괄 처리 및 스프레드시트 입력을 시작합니다 ---")
 
     # --- Google API 인증 (Gemini 및 Sheets) ---
@@ -217,14 +771,15 @@ def main():
         creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
         client = gspread.authorize(creds)
         spreadsheet = client.open(SPREADSHEET_NAME)
-        worksheet = spreadsheet.sheet1
+        # 시트 목록을 한 번만 조회해 기본 시트와 오류 로그 시트를 함께 찾음
+        worksheets = spreadsheet.worksheets()
+        worksheet = worksheets[0]
         
         # 오류 로그 시트 설정
-        try:
-            log_worksheet = spreadsheet.worksheet("오류_로그")
-        except gspread.exceptions.WorksheetNotFound:
+        log_worksheet = next((ws for ws in worksheets if ws.title == "오류_로그"), None)
+        if log_worksheet is None:
             log_worksheet = spreadsheet.add_worksheet(title="오류_로그", rows="100", cols="10")
-            log_worksheet.append_row(["파일 이름", "오류 내용", "처리 시간"])
+            call_with_backoff(log_worksheet.append_row, ["파일 이름", "오류 내용", "처리 시간"])
         
         print("✅ 구글 스프레드시트 연결 성공!")
     except Exception as e:
@@ -233,22 +788,33 @@ def main():
 
     # 헤더 설정
     try:
-        first_row = worksheet.row_values(1)
-        if not first_row:
-            print("📝 1행이 비어있어 헤더를 추가합니다...")
-            headers = ["파일이름", "행번호"] + EXTRACTION_FIELDS
-            worksheet.append_row(headers)
-        else:
-            print("📝 헤더가 이미 존재합니다.")
+        ensure_headers(spreadsheet, worksheet, ["파일이름", "행번호"] + EXTRACTION_FIELDS)
     except Exception as e:
         print(f"❌ 헤더 확인 중 오류 발생: {e}")
 
     # PDF 파일 목록 가져오기
     try:
-        pdf_files = [f for f in os.listdir(PDF_FOLDER_PATH) if f.lower().endswith('.pdf')]
-        if not pdf_files:
+        pdf_entries = list_pdf_files(PDF_FOLDER_PATH)
+        # 0바이트 PDF는 처리할 내용이 없고 mmap도 실패하므로 미리 제외
+        empty_files = [pdf_entry[0] for pdf_entry in pdf_entries if pdf_entry[1] == 0]
+        if empty_files:
+            print(f"⚠️ 빈(0바이트) PDF 파일 {len(empty_files)}개를 건너뜁니다: {empty_files}")
+            pdf_entries = [pdf_entry for pdf_entry in pdf_entries if pdf_entry[1] > 0]
+        if not pdf_entries:
             print(f"❌ '{PDF_FOLDER_PATH}' 폴더에 PDF 파일이 없습니다.")
             return
+        # 이전 실행에서 같은 스프레드시트에 기록을 마친 PDF(이름과 내용이 같은 파일)는 건너뜀
+        if SKIP_PROCESSED:
+            stat_keys, hashes_by_name = load_processed_files(spreadsheet.id)
+            skipped_count = len(pdf_entries)
+            pdf_entries = [pdf_entry for pdf_entry in pdf_entries if not is_processed(pdf_entry, stat_keys, hashes_by_name)]
+            skipped_count -= len(pdf_entries)
+            if skipped_count:
+                print(f"⏭️ 이미 처리된 PDF {skipped_count}개를 건너뜁니다.")
+            if not pdf_entries:
+                print("✅ 새로 처리할 PDF 파일이 없습니다.")
+                return
+        pdf_files = [pdf_entry[0] for pdf_entry in pdf_entries]
         print(f"\n📂 총 {len(pdf_files)}개의 PDF 파일을 처리합니다: {pdf_files}")
     except FileNotFoundError:
         print(f"❌ 폴더를 찾을 수 없습니다: '{PDF_FOLDER_PATH}'")
@@ -257,60 +823,58 @@ def main():
     total_rows_added = 0
     error_count = 0
 
-    # 각 PDF 파일 처리
-    for pdf_file in pdf_files:
+    all_rows = []
+    all_log_rows = []
+    processed_files = set()
+    _prompt_cache = create_prompt_cache(GEMINI_PROMPT)
+    try:
+        # 각 PDF 파일 처리 (추출과 행 생성은 병렬로 실행하고, 스프레드시트 기록은 메인 스레드에서 처리)
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
         try:
-            full_path = os.path.join(PDF_FOLDER_PATH, pdf_file)
-            print(f"\n🔄 '{pdf_file}' 처리 중...")
-            
-            # 데이터 추출
-            extracted_data_list = extract_data_with_gemini(full_path, GEMINI_PROMPT)
-            
-            # 데이터 검증 및 수정
-            validated_data = validate_and_fix_data(extracted_data_list)
-            
-            if not validated_data:
-                print(f"⚠️ '{pdf_file}'에서 유효한 데이터를 찾지 못했습니다.")
-                import datetime
-                log_worksheet.append_row([pdf_file, "유효한 데이터 없음", datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
-                continue
-            
-            # 스프레드시트에 추가할 행들 준비
-            rows_to_append = []
-            for i, extracted_data in enumerate(validated_data):
-                # 첫 번째 행에만 파일 이름 표시, 나머지는 빈 문자열
-                file_name_to_log = pdf_file if i == 0 else ""
-                row_number = i + 1
-                
-                data_row = [file_name_to_log, row_number]
-                for field in EXTRACTION_FIELDS:
-                    value = extracted_data.get(field, 'N/A')
-                    if isinstance(value, str):
-                        value = value.replace('\n', ' ').replace('\r', ' ')
-                    if field in currency_fields:
-                        value = clean_currency(str(value))
-                    data_row.append(str(value))
-                
-                rows_to_append.append(data_row)
-            
-            # 한 번에 모든 행 추가 (효율성 증대)
-            if rows_to_append:
-                worksheet.append_rows(rows_to_append)
-                total_rows_added += len(rows_to_append)
-            
-            print(f"✅ '{pdf_file}' 처리 완료!")
-            print(f"   📊 추출된 데이터: {len(validated_data)}개 항목")
-            print(f"   📝 스프레드시트 추가: {len(rows_to_append)}개 행")
+            futures = [executor.submit(process_one, pdf_file) for pdf_file in pdf_files]
+
+            for future in as_completed(futures):
+                refresh_prompt_cache()
+                pdf_file, rows_to_append, error = future.result()
 
+                if error is not None:
+                    print(f"🚨 '{pdf_file}' 처리 중 오류 발생: {error}")
+
+                    # 오류 로그도 모아서 마지막에 한 번에 기록
+                    all_log_rows.append([pdf_file, str(error), _dt.now().strftime(LOG_TIME_FORMAT)])
+                    error_count += 1
+                    continue
+
+                if not rows_to_append:
+                    print(f"⚠️ '{pdf_file}'에서 유효한 데이터를 찾지 못했습니다.")
+                    all_log_rows.append([pdf_file, "유효한 데이터 없음", _dt.now().strftime(LOG_TIME_FORMAT)])
+                    continue
+
+                # 모든 PDF의 행을 모아 마지막에 한 번에 추가 (효율성 증대)
+                all_rows.extend(rows_to_append)
+                processed_files.add(pdf_file)
+
+                print(f"✅ '{pdf_file}' 처리 완료!")
+                print(f"   📝 스프레드시트 추가 예정: {len(rows_to_append)}개 행")
+        finally:
+            # Ctrl-C 등으로 중단되면 아직 시작하지 않은 PDF는 요청하지 않고, 진행 중인 요청도 기다리지 않고 바로 저장
+            # (정상 종료 시에는 모든 작업이 이미 끝난 상태)
+            executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        # 중단(Ctrl-C 등)되더라도 지금까지 처리한 결과는 저장
+        try:
+            flush_rows(worksheet, all_rows)
+            total_rows_added = len(all_rows)
+            mark_processed_files(spreadsheet.id, [pdf_entry for pdf_entry in pdf_entries if pdf_entry[0] in processed_files])
         except Exception as e:
-            error_message = f"🚨 '{pdf_file}' 처리 중 오류 발생: {e}"
-            print(error_message)
-            
-            # 오류 로그에 기록
-            import datetime
-            log_worksheet.append_row([pdf_file, str(e), datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")])
-            error_count += 1
-            continue
+            print(f"❌ 스프레드시트 기록 중 오류 발생: {e}")
+        try:
+            flush_rows(log_worksheet, all_log_rows)
+        except Exception as e:
+            print(f"❌ 오류 로그 기록 중 오류 발생: {e}")
+        delete_prompt_cache(_prompt_cache)
+        _prompt_cache = None
+        _cleanup_executor.shutdown(wait=True)
 
     # 최종 결과 출력
     print(f"\n--- ✨ 모든 작업이 완료되었습니다 ---")